@@ -3,58 +3,17 @@
 在构建时下载 CodeBERT 模型的脚本
 """
 import os
-import ssl
 import sys
 
-# 必须在所有导入之前禁用 SSL
-os.environ["PYTHONHTTPSVERIFY"] = "0"
-os.environ["CURL_CA_BUNDLE"] = ""
-os.environ["REQUESTS_CA_BUNDLE"] = ""
-os.environ["SSL_CERT_FILE"] = ""
-os.environ["HF_HUB_DISABLE_SSL_VERIFY"] = "1"
+import certifi
+
+# 使用 certifi 的 CA 证书包校验 HTTPS，复用默认连接池
+os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
+os.environ["SSL_CERT_FILE"] = certifi.where()
 os.environ["HF_HUB_DISABLE_EXPERIMENTAL_WARNING"] = "1"
 os.environ["TRANSFORMERS_OFFLINE"] = "0"  # 确保在线下载
 os.environ["HF_HUB_DISABLE_XET"] = "1"  # 禁用 xet 下载方式，使用传统 HTTP
-
-# 修改默认 SSL context
-ssl._create_default_https_context = ssl._create_unverified_context
-
-# Patch urllib3
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Patch requests
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.ssl_ import create_urllib3_context
-
-class NoSSLAdapter(HTTPAdapter):
-    def init_poolmanager(self, *args, **kwargs):
-        ctx = create_urllib3_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        kwargs['ssl_context'] = ctx
-        return super().init_poolmanager(*args, **kwargs)
-
-# Patch requests.Session
-original_init = requests.Session.__init__
-def patched_init(self, *args, **kwargs):
-    original_init(self, *args, **kwargs)
-    self.mount('https://', NoSSLAdapter())
-    self.verify = False
-
-requests.Session.__init__ = patched_init
-
-# Patch huggingface_hub 的 HTTP 客户端
-try:
-    from huggingface_hub.utils import _http
-    original_http_backoff = _http.http_backoff
-    def patched_http_backoff(*args, **kwargs):
-        kwargs.setdefault('verify', False)
-        return original_http_backoff(*args, **kwargs)
-    _http.http_backoff = patched_http_backoff
-except ImportError:
-    pass  # huggingface_hub 可能还没导入
+os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"  # 使用 hf_transfer 多连接并行下载大文件
 
 # 使用 huggingface_hub 直接下载文件，不需要加载模型
 from huggingface_hub import snapshot_download
@@ -77,7 +36,8 @@ def download_model():
             resume_download=True,
             ignore_patterns=["*.md", "*.txt"],  # 忽略文档文件，只下载必需文件
             local_dir=None,  # 使用默认缓存目录
-            local_dir_use_symlinks=False  # 不使用符号链接
+            local_dir_use_symlinks=False,  # 不使用符号链接
+            max_workers=8  # 并行下载多个文件
         )
         
         print(f"✓ 模型文件下载成功！")
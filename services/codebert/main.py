@@ -4,10 +4,13 @@ A FastAPI microservice that provides code embedding using Microsoft's CodeBERT m
 """
 
 import os
+import asyncio
 import logging
 import ssl
+import threading
 import urllib3
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
 # Disable SSL verification BEFORE importing transformers
@@ -41,10 +44,12 @@ def patched_session_init(self, *args, **kwargs):
     self.verify = False  # 额外设置
 requests.Session.__init__ = patched_session_init
 
+import numpy as np
 import torch
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, BatchEncoding
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -54,6 +59,30 @@ logger = logging.getLogger(__name__)
 model = None
 tokenizer = None
 device = None
+dimension = 768
+backend = "torch"
+static_shapes = False
+use_cuda_graphs = False
+
+# Fixed sequence lengths and batch sizes the compiled model is specialized for
+LENGTH_BUCKETS = [64, 128, 256, 512]
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32]
+
+# CUDA graphs captured per (batch size, sequence length) bucket
+cuda_graphs = {}
+cuda_graph_lock = threading.Lock()
+
+# Maximum number of length-sorted texts per forward pass in a batch request
+BATCH_CHUNK = int(os.getenv("BATCH_CHUNK", "32"))
+
+# Dynamic batching of concurrent requests
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", "5"))
+batch_queue = None
+
+# Blocking model work runs on one dedicated thread so the event loop stays free and
+# torch.compile / CUDA graph state is always used from the thread that created it
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
 
 
 class EmbeddingRequest(BaseModel):
@@ -89,16 +118,99 @@ class HealthResponse(BaseModel):
     dimension: int
 
 
+def load_torch_model(model_name: str):
+    """Load the PyTorch model and apply the configured inference optimizations"""
+    global static_shapes, use_cuda_graphs
+    
+    model = AutoModel.from_pretrained(model_name)
+    # Return plain tuples instead of building a ModelOutput on every call
+    model.config.return_dict = False
+    model.to(device)
+    model.eval()
+    
+    # Half precision on GPU to run every GEMM on tensor cores. The weights are cast
+    # directly rather than autocasting, which would also disable the BetterTransformer
+    # fused encoder path.
+    if device.type == "cuda":
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        model = model.to(dtype)
+        logger.info(f"Using {dtype} weights")
+    
+    # Int8 dynamic quantization of Linear layers for CPU deployment
+    quantized = device.type == "cpu" and os.getenv("QUANTIZE_CPU", "0") == "1"
+    if quantized:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("Int8 dynamic quantization enabled")
+    
+    # Manually captured CUDA graphs replace torch.compile, which captures its own
+    use_cuda_graphs = device.type == "cuda" and os.getenv("USE_CUDA_GRAPHS", "0") == "1"
+    use_compile = os.getenv("USE_COMPILE", "1" if device.type == "cuda" else "0") == "1" and not use_cuda_graphs
+    
+    # Route the encoder through PyTorch's fused attention fastpath. It needs float
+    # Linear weights, and its data-dependent nested tensors cannot be captured in a
+    # CUDA graph, so it is skipped for quantized models and whenever graphs are used.
+    if os.getenv("USE_BT", "1") == "1" and not quantized and not use_cuda_graphs and not use_compile:
+        try:
+            from optimum.bettertransformer import BetterTransformer
+            model = BetterTransformer.transform(model, keep_original_model=False)
+            logger.info("BetterTransformer fastpath enabled")
+        except Exception as e:
+            logger.warning(f"BetterTransformer unavailable, using stock attention: {e}")
+    
+    if use_cuda_graphs:
+        static_shapes = True
+        logger.info("CUDA graphs enabled")
+    
+    # Compile the forward pass for a fixed set of (batch size, length) buckets
+    if use_compile:
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit,
+            len(BATCH_BUCKETS) * len(LENGTH_BUCKETS)
+        )
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        static_shapes = True
+        logger.info("torch.compile enabled")
+    
+    return model
+
+
+def load_onnx_model(model_name: str):
+    """Export the model to ONNX and serve it through ONNX Runtime"""
+    global device
+    
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    
+    # ONNX Runtime has no MPS execution provider
+    if device.type == "mps":
+        device = torch.device("cpu")
+        logger.info("ONNX Runtime does not support MPS, falling back to CPU")
+    
+    use_cuda = device.type == "cuda"
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        model_name,
+        export=True,
+        provider="CUDAExecutionProvider" if use_cuda else "CPUExecutionProvider",
+        use_io_binding=use_cuda
+    )
+    logger.info("ONNX Runtime backend enabled")
+    return model
+
+
 def load_model():
     """Load CodeBERT model and tokenizer"""
-    global model, tokenizer, device
+    global model, tokenizer, device, dimension, backend
     
     model_name = os.getenv("MODEL_NAME", "microsoft/codebert-base")
     logger.info(f"Loading model: {model_name}")
     
+    # Pin intra-op threads per worker so multiple workers don't oversubscribe the CPU
+    torch.set_num_threads(int(os.getenv("TORCH_THREADS", "4")))
+    torch.set_num_interop_threads(1)
+    
     # Determine device
     if torch.cuda.is_available():
         device = torch.device("cuda")
+        torch.backends.cudnn.benchmark = True
         logger.info("Using CUDA GPU")
     elif torch.backends.mps.is_available():
         device = torch.device("mps")
@@ -108,10 +220,15 @@ def load_model():
         logger.info("Using CPU")
     
     # Load tokenizer and model
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name)
-    model.to(device)
-    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    tokenizer.padding_side = "right"
+    tokenizer.model_max_length = LENGTH_BUCKETS[-1]
+    backend = os.getenv("BACKEND", "torch")
+    if backend == "onnx":
+        model = load_onnx_model(model_name)
+    else:
+        model = load_torch_model(model_name)
+    dimension = model.config.hidden_size
     
     logger.info(f"Model loaded successfully on {device}")
     return model, tokenizer
@@ -120,10 +237,21 @@ def load_model():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for model loading"""
-    load_model()
+    global batch_queue
+    
+    # Load on the inference thread too: dynamo config overrides such as
+    # cache_size_limit are thread-local and must apply where compilation runs
+    await run_inference(load_model)
+    await run_inference(warmup_model)
+    await run_inference(capture_cuda_graphs)
+    
+    batch_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
     yield
     # Cleanup (if needed)
     logger.info("Shutting down...")
+    worker.cancel()
+    inference_executor.shutdown(wait=False)
 
 
 # Create FastAPI app
@@ -135,62 +263,234 @@ app = FastAPI(
 )
 
 
-def generate_embedding(text: str, max_length: int = 512) -> List[float]:
-    """Generate embedding for a single text"""
-    global model, tokenizer, device
+def next_bucket(value: int, buckets: List[int]) -> int:
+    """Round a sequence length or batch size up to the nearest bucket"""
+    for bucket in buckets:
+        if value <= bucket:
+            return bucket
+    return buckets[-1]
+
+
+def pad_encoded(encoded):
+    """Pad tokenized inputs to the longest sequence, or to (batch, length) buckets for static shapes"""
+    if not static_shapes:
+        return tokenizer.pad(encoded, padding=True, return_tensors="pt")
     
-    if model is None or tokenizer is None:
-        raise RuntimeError("Model not loaded")
+    # Fill the batch bucket by repeating the first row; callers keep only the original rows
+    rows = len(encoded["input_ids"])
+    extra = next_bucket(rows, BATCH_BUCKETS) - rows
+    if extra > 0:
+        encoded = {k: list(v) + [v[0]] * extra for k, v in encoded.items()}
     
-    # Tokenize input
-    inputs = tokenizer(
-        text,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=max_length
+    longest = max(len(ids) for ids in encoded["input_ids"])
+    return tokenizer.pad(
+        encoded,
+        padding="max_length",
+        max_length=next_bucket(longest, LENGTH_BUCKETS),
+        return_tensors="pt"
     )
+
+
+def to_device(inputs: BatchEncoding) -> BatchEncoding:
+    """Move tokenized inputs to the model device"""
+    # Pinned host memory lets the copy overlap with queued GPU work. ONNX Runtime
+    # runs on its own stream, so it only gets synchronous copies.
+    if device.type == "cuda" and backend == "torch":
+        return BatchEncoding({k: v.pin_memory().to(device, non_blocking=True) for k, v in inputs.items()})
+    return inputs.to(device)
+
+
+@torch.inference_mode()
+def warmup_model():
+    """Run dummy forwards per shape bucket so compilation and kernel selection happen before serving"""
+    if os.getenv("WARMUP", "1") != "1":
+        return
     
-    # Move to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    # Static shapes need every (batch, length) pair compiled; otherwise a few sizes suffice
+    batch_sizes = BATCH_BUCKETS if static_shapes else (1, 8)
+    for batch_size in batch_sizes:
+        for length in LENGTH_BUCKETS:
+            inputs = tokenizer(
+                ["x"] * batch_size,
+                return_tensors="pt",
+                padding="max_length",
+                truncation=True,
+                max_length=length
+            )
+            inputs = to_device(inputs)
+            model(**inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    logger.info(f"Warmed up batch sizes {list(batch_sizes)} x length buckets {LENGTH_BUCKETS}")
+
+
+@torch.inference_mode()
+def capture_cuda_graphs():
+    """Capture one CUDA graph per (batch size, length) bucket with static input and output buffers"""
+    if not use_cuda_graphs:
+        return
     
-    # Generate embedding
-    with torch.no_grad():
-        outputs = model(**inputs)
-        # Use mean pooling of last hidden state
-        embeddings = outputs.last_hidden_state.mean(dim=1)
+    pool = torch.cuda.graph_pool_handle()
+    for batch_size in BATCH_BUCKETS:
+        for length in LENGTH_BUCKETS:
+            static_inputs = tokenizer(
+                ["x"] * batch_size,
+                return_tensors="pt",
+                padding="max_length",
+                truncation=True,
+                max_length=length
+            ).to(device)
+            
+            # Warm up on a side stream before capture, as required by torch.cuda.graph
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    model(**static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+            
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=pool):
+                static_output = model(**static_inputs)[0]
+            cuda_graphs[(batch_size, length)] = (graph, static_inputs, static_output)
     
-    # Convert to list and return
-    return embeddings[0].cpu().tolist()
+    torch.cuda.synchronize()
+    logger.info(f"Captured {len(cuda_graphs)} CUDA graphs")
 
 
-def generate_batch_embeddings(texts: List[str], max_length: int = 512) -> List[List[float]]:
+def forward(inputs: BatchEncoding) -> torch.Tensor:
+    """Run the model and return the last hidden state, replaying a CUDA graph when the shape is cached"""
+    entry = cuda_graphs.get(tuple(inputs["input_ids"].shape))
+    if entry is None:
+        return model(**inputs)[0]
+    
+    # Graphs share static buffers and a memory pool, so replays must not overlap
+    graph, static_inputs, static_output = entry
+    with cuda_graph_lock:
+        for k, v in static_inputs.items():
+            v.copy_(inputs[k])
+        graph.replay()
+        return static_output.clone()
+
+
+def mean_pool(last_hidden_state: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """Average token embeddings over non-padding positions, returned as float32"""
+    hidden = last_hidden_state.float()
+    mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+    summed = (hidden * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1)
+    return summed / counts
+
+
+@torch.inference_mode()
+def generate_batch_embeddings(texts: List[str], max_length: int = 512) -> np.ndarray:
     """Generate embeddings for multiple texts"""
     global model, tokenizer, device
     
     if model is None or tokenizer is None:
         raise RuntimeError("Model not loaded")
     
-    # Tokenize inputs
-    inputs = tokenizer(
-        texts,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=max_length
-    )
+    # Never process more tokens than the model supports
+    max_length = min(max_length or tokenizer.model_max_length, tokenizer.model_max_length)
+    
+    # A single text needs no sorting or padding unless the model uses static shapes
+    if len(texts) == 1 and not static_shapes:
+        inputs = tokenizer.encode_plus(
+            texts[0],
+            return_tensors="pt",
+            padding=False,
+            truncation=True,
+            max_length=max_length
+        )
+        inputs = to_device(inputs)
+        last_hidden_state = forward(inputs)
+        return mean_pool(last_hidden_state, inputs["attention_mask"]).cpu().numpy()
     
-    # Move to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    # Tokenize without padding and sort by length so each chunk pads to a similar length
+    encoded = tokenizer(texts, truncation=True, max_length=max_length)
+    lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+    order = np.argsort(lengths, kind="stable")
     
-    # Generate embeddings
-    with torch.no_grad():
-        outputs = model(**inputs)
-        # Use mean pooling of last hidden state
-        embeddings = outputs.last_hidden_state.mean(dim=1)
+    # Static shapes cannot exceed the largest batch bucket
+    chunk_size = min(BATCH_CHUNK, BATCH_BUCKETS[-1]) if static_shapes else BATCH_CHUNK
     
-    # Convert to list and return
-    return embeddings.cpu().tolist()
+    chunks = []
+    for start in range(0, len(order), chunk_size):
+        indices = order[start:start + chunk_size]
+        inputs = pad_encoded({k: [v[i] for i in indices] for k, v in encoded.items()})
+        
+        # Move to device
+        inputs = to_device(inputs)
+        
+        # Generate embeddings
+        last_hidden_state = forward(inputs)
+        # Use masked mean pooling of last hidden state
+        embeddings = mean_pool(last_hidden_state, inputs["attention_mask"])
+        # Drop the rows added to fill a batch bucket
+        chunks.append(embeddings[:len(indices)].cpu())
+    
+    # Restore the original input order
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    embeddings = torch.cat(chunks)[torch.from_numpy(inverse)]
+    
+    # Convert to numpy and return
+    return embeddings.numpy()
+
+
+async def run_inference(func, *args):
+    """Run blocking model work on the inference thread without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, func, *args)
+
+
+async def batch_worker():
+    """Coalesce queued texts into batched forward passes"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        # Wait for the first item, then collect more until the batch is full or the wait expires
+        items = [await batch_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(items) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Group by max_length so every request keeps its own truncation
+        groups = {}
+        for text, max_length, future in items:
+            groups.setdefault(max_length, []).append((text, future))
+        
+        for max_length, group in groups.items():
+            try:
+                texts = [text for text, _ in group]
+                embeddings = await run_inference(generate_batch_embeddings, texts, max_length)
+            except Exception as e:
+                for _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(group, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+
+async def embed_queued(texts: List[str], max_length: int) -> np.ndarray:
+    """Submit texts to the dynamic batcher and wait for their embeddings"""
+    loop = asyncio.get_running_loop()
+    
+    futures = []
+    for text in texts:
+        future = loop.create_future()
+        batch_queue.put_nowait((text, max_length, future))
+        futures.append(future)
+    return np.stack(await asyncio.gather(*futures))
 
 
 @app.get("/health", response_model=HealthResponse)
@@ -199,14 +499,11 @@ async def health_check():
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    # Get embedding dimension
-    test_embedding = generate_embedding("test")
-    
     return HealthResponse(
         status="healthy",
         model="microsoft/codebert-base",
         device=str(device),
-        dimension=len(test_embedding)
+        dimension=dimension
     )
 
 
@@ -214,11 +511,12 @@ async def health_check():
 async def embed_text(request: EmbeddingRequest):
     """Generate embedding for a single text"""
     try:
-        embedding = generate_embedding(request.text, request.max_length)
-        return EmbeddingResponse(
-            embedding=embedding,
-            dimension=len(embedding)
-        )
+        embedding = (await embed_queued([request.text], request.max_length))[0]
+        # Serialize the numpy buffer directly instead of validating every float
+        return ORJSONResponse({
+            "embedding": embedding,
+            "dimension": embedding.shape[0]
+        })
     except Exception as e:
         logger.error(f"Error generating embedding: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -229,18 +527,23 @@ async def embed_batch(request: BatchEmbeddingRequest):
     """Generate embeddings for multiple texts"""
     try:
         if len(request.texts) == 0:
-            return BatchEmbeddingResponse(
-                embeddings=[],
-                dimension=768,
-                count=0
-            )
+            return ORJSONResponse({
+                "embeddings": [],
+                "dimension": dimension,
+                "count": 0
+            })
         
-        embeddings = generate_batch_embeddings(request.texts, request.max_length)
-        return BatchEmbeddingResponse(
-            embeddings=embeddings,
-            dimension=len(embeddings[0]) if embeddings else 768,
-            count=len(embeddings)
-        )
+        # Small batches are coalesced with concurrent requests, large ones run directly
+        if len(request.texts) <= MAX_BATCH_SIZE:
+            embeddings = await embed_queued(request.texts, request.max_length)
+        else:
+            embeddings = await run_inference(generate_batch_embeddings, request.texts, request.max_length)
+        # Serialize the numpy buffer directly instead of validating every float
+        return ORJSONResponse({
+            "embeddings": embeddings,
+            "dimension": embeddings.shape[1],
+            "count": embeddings.shape[0]
+        })
     except Exception as e:
         logger.error(f"Error generating batch embeddings: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -263,5 +566,7 @@ async def root():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Multiple workers parallelize CPU-side work; on GPU a single worker feeds the dynamic batcher
+    workers = int(os.getenv("WORKERS", "1" if torch.cuda.is_available() else "2"))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
 